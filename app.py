@@ -1,15 +1,22 @@
+import os
 import numpy as np
 import pandas as pd
 from sklearn.model_selection import train_test_split
 from sklearn.base import BaseEstimator, TransformerMixin
 from sklearn.pipeline import Pipeline
-from sklearn.preprocessing import OneHotEncoder, MinMaxScaler
+from sklearn.preprocessing import MinMaxScaler
 from sklearn.ensemble import RandomForestRegressor
 import joblib
 import streamlit as st
 import requests
 from streamlit_lottie import st_lottie_spinner
-from streamlit import cache_data
+from streamlit import cache_data, cache_resource
+
+# onnx runtime is optional, it serves the forest exported by convert_model.py
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
 
 # Apply custom CSS for font style and color changes
 st.markdown("""
@@ -35,9 +42,35 @@ st.markdown("""
     </style>
 """, unsafe_allow_html=True)
 
-full_data = pd.read_csv(
-    "datasets/train.csv"
-)
+# string features stored as categories so comparisons, mode and unique work on integer codes
+cat_cols = [
+    "Gender",
+    "Income Stability",
+    "Profession",
+    "Location",
+    "Expense Type 1",
+    "Expense Type 2",
+    "Has Active Credit Card",
+    "Property Location",
+]
+
+# narrowed dtypes of the features, so pandas does not infer them or upcast to float64
+train_dtypes = {
+    **{ft: "category" for ft in cat_cols},
+    "Age": "int16",
+    "Income (USD)": "float32",
+    "Loan Amount Request (USD)": "float32",
+    "Current Loan Expenses (USD)": "float32",
+    "Dependents": "float32",
+    "Credit Score": "float32",
+    "No. of Defaults": "int8",
+    "Property ID": "int16",
+    "Property Age": "float32",
+    "Property Type": "int8",
+    "Co-Applicant": "int16",
+    "Property Price": "float32",
+    "Loan Sanction Amount (USD)": "float32",
+}
 
 
 # split the data into train and test
@@ -46,10 +79,14 @@ def data_split(df, test_size):
     return train_df.reset_index(drop=True), test_df.reset_index(drop=True)
 
 
-train_original, test_original = data_split(full_data, 0.2)
+# the csv is parsed and split once, cache_data hands every rerun its own copy
+@cache_data
+def load_train():
+    full_data = pd.read_csv("datasets/train.csv", dtype=train_dtypes)
+    return data_split(full_data, 0.2)
+
 
-train_copy = train_original.copy()
-test_copy = test_original.copy()
+train_copy, test_copy = load_train()
 
 
 ####################### Classes used to preprocess the data ##############################
@@ -65,26 +102,38 @@ class OutlierImputer(BaseEstimator, TransformerMixin):
             "Property Age",
             "Property Price",
         ],
+        training_only=True,
     ):
         self.feat_with_outliers = feat_with_outliers
-
-    def fit(self, df):
+        self.training_only = training_only
+
+    def fit(self, df, y=None):
+        self.feat_set_ = frozenset(self.feat_with_outliers)
+        # 25% and 75% quantiles of the training data
+        Q1 = df[self.feat_with_outliers].quantile(0.25).to_numpy()
+        Q3 = df[self.feat_with_outliers].quantile(0.75).to_numpy()
+        IQR = Q3 - Q1
+        # bounds of the data kept, within 1.5 IQR of the quartiles
+        self.low_ = Q1 - 1.5 * IQR
+        self.high_ = Q3 + 1.5 * IQR
         return self
 
+    def fit_transform(self, df, y=None):
+        # outliers are always removed from the data the pipeline is fitted on
+        return self.fit(df)._remove_outliers(df)
+
     def transform(self, df):
-        if set(self.feat_with_outliers).issubset(df.columns):
-            # 25% quantile
-            Q1 = df[self.feat_with_outliers].quantile(0.25)
-            # 75% quantile
-            Q3 = df[self.feat_with_outliers].quantile(0.75)
-            IQR = Q3 - Q1
-            # keep the data within 3 IQR
-            df = df[
-                ~(
-                    (df[self.feat_with_outliers] < (Q1 - 1.5 * IQR))
-                    | (df[self.feat_with_outliers] > (Q3 + 1.5 * IQR))
-                ).any(axis=1)
-            ]
+        # a new profile to predict must never be filtered out
+        if self.training_only:
+            return df
+        return self._remove_outliers(df)
+
+    def _remove_outliers(self, df):
+        if self.feat_set_.issubset(df.columns):
+            values = df[self.feat_with_outliers].to_numpy()
+            # keep the data within the fitted bounds
+            outliers = ((values < self.low_) | (values > self.high_)).any(axis=1)
+            df = df[~outliers]
             return df
         else:
             print("One or more features are not in the dataframe")
@@ -111,21 +160,24 @@ class MissingValueImputer(BaseEstimator, TransformerMixin):
         self.mode_imputed_ft = mode_imputed_ft
         self.median_imputed_ft = median_imputed_ft
 
-    def fit(self, df):
+    def fit(self, df, y=None):
+        self.feat_set_ = frozenset(self.mode_imputed_ft + self.median_imputed_ft)
+        # learn the values to impute on the training data, a single profile has no mode or median of its own
+        self.mode_vals_ = {ft: df[ft].mode()[0] for ft in self.mode_imputed_ft}
+        # medians of the whole numeric block in one vectorized pass
+        self.median_vals_ = df[self.median_imputed_ft].median().to_dict()
         return self
 
+    def fit_transform(self, df, y=None):
+        if "Loan Sanction Amount (USD)" in df.columns:
+            # drop missing values in the target feature, only needed for training
+            df = df.dropna(axis=0, subset=["Loan Sanction Amount (USD)"])
+        return self.fit(df).transform(df)
+
     def transform(self, df):
-        if set(self.mode_imputed_ft + self.median_imputed_ft).issubset(df.columns):
-            # drop missing values in the target feature
-            df.dropna(inplace=True, axis=0, subset=["Loan Sanction Amount (USD)"])
-            # impute missing values with mode
-            for ft in self.mode_imputed_ft:
-                the_mode = df[ft].mode()[0]
-                df[ft] = df[ft].fillna(the_mode)
-            # impute missing values with median
-            for ft in self.median_imputed_ft:
-                the_median = df[ft].median()
-                df[ft] = df[ft].fillna(the_median)
+        if self.feat_set_.issubset(df.columns):
+            # impute missing values with mode and median in a single fillna
+            df.fillna({**self.mode_vals_, **self.median_vals_}, inplace=True)
             return df
         else:
             print("One or more features are not in the dataframe")
@@ -133,16 +185,33 @@ class MissingValueImputer(BaseEstimator, TransformerMixin):
 
 
 class DropUncommonProfession(BaseEstimator, TransformerMixin):
-    def __init__(self, profession_list=["Student", "Unemployed", "Businessman"]):
+    def __init__(
+        self,
+        profession_list=["Student", "Unemployed", "Businessman"],
+        training_only=True,
+    ):
         self.profession_list = profession_list
+        self.training_only = training_only
 
-    def fit(self, df):
+    def fit(self, df, y=None):
+        # hashed once instead of on every transform
+        self.profession_index_ = pd.Index(self.profession_list)
         return self
 
+    def fit_transform(self, df, y=None):
+        # uncommon professions are always removed from the data the pipeline is fitted on
+        return self.fit(df)._drop_professions(df)
+
     def transform(self, df):
+        # a new profile to predict must never be filtered out
+        if self.training_only:
+            return df
+        return self._drop_professions(df)
+
+    def _drop_professions(self, df):
         if "Profession" in df.columns:
             # only keep the professions that are not in the profession_list
-            df = df[~df["Profession"].isin(self.profession_list)]
+            df = df[~df["Profession"].isin(self.profession_index_)]
             return df
         else:
             print("Profession feature is not in the dataframe")
@@ -156,11 +225,12 @@ class DropFeatures(BaseEstimator, TransformerMixin):
     ):
         self.feature_to_drop = feature_to_drop
 
-    def fit(self, df):
+    def fit(self, df, y=None):
+        self.feat_set_ = frozenset(self.feature_to_drop)
         return self
 
     def transform(self, df):
-        if set(self.feature_to_drop).issubset(df.columns):
+        if self.feat_set_.issubset(df.columns):
             df.drop(self.feature_to_drop, axis=1, inplace=True)
             return df
         else:
@@ -180,14 +250,16 @@ class ValueImputer(BaseEstimator, TransformerMixin):
     ):
         self.feat_with_999_val = feat_with_999_val
 
-    def fit(self, df):
+    def fit(self, df, y=None):
+        self.feat_set_ = frozenset(self.feat_with_999_val)
         return self
 
     def transform(self, df):
-        if set(self.feat_with_999_val).issubset(df.columns):
-            for ft in self.feat_with_999_val:
-                # replace any occurance of -999.000 with 0
-                df[ft].replace(-999.000, 0, inplace=True, regex=True)
+        if self.feat_set_.issubset(df.columns):
+            # replace any occurance of -999.000 with 0, in a single pass over the features
+            values = df[self.feat_with_999_val].to_numpy(copy=True)
+            values[values == -999.000] = 0
+            df[self.feat_with_999_val] = values
             return df
         else:
             print("One or more features are not in the dataframe")
@@ -209,15 +281,22 @@ class MinMaxWithFeatNames(BaseEstimator, TransformerMixin):
     ):
         self.min_max_scaler_ft = min_max_scaler_ft
 
-    def fit(self, df):
+    def fit(self, df, y=None):
+        self.feat_set_ = frozenset(self.min_max_scaler_ft)
+        # learn the min and max of each feature once, on the training data
+        scaler = MinMaxScaler().fit(df[self.min_max_scaler_ft])
+        self.mins_ = scaler.data_min_.astype(np.float32)
+        # 1 / (max - min), constant features are left unscaled
+        self.scales_ = scaler.scale_.astype(np.float32)
         return self
 
     def transform(self, df):
-        if set(self.min_max_scaler_ft).issubset(df.columns):
-            min_max_enc = MinMaxScaler()
-            df[self.min_max_scaler_ft] = min_max_enc.fit_transform(
-                df[self.min_max_scaler_ft]
-            )
+        if self.feat_set_.issubset(df.columns):
+            # scale the features as one float32 block in place, then write it back once
+            values = df[self.min_max_scaler_ft].to_numpy(dtype=np.float32, copy=True)
+            values -= self.mins_
+            values *= self.scales_
+            df[self.min_max_scaler_ft] = values
             return df
         else:
             print("One or more features are not in the dataframe")
@@ -240,41 +319,43 @@ class OneHotWithFeatNames(BaseEstimator, TransformerMixin):
     ):
         self.one_hot_enc_ft = one_hot_enc_ft
 
-    def fit(self, df):
+    def fit(self, df, y=None):
+        self.feat_set_ = frozenset(self.one_hot_enc_ft)
+        # learn the sorted categories of each feature once, on the training data,
+        # categories of the rows dropped by the previous steps are not encoded
+        self.categories_ = {}
+        self.col_offsets_ = {}
+        feat_names = []
+        for ft in self.one_hot_enc_ft:
+            categories = df[ft].cat.remove_unused_categories().cat.categories
+            self.categories_[ft] = categories
+            self.col_offsets_[ft] = len(feat_names)
+            feat_names += ["{0}_{1}".format(ft, cat) for cat in categories]
+        # the result of the one hot encoding columns names
+        self.feat_names_ = np.array(feat_names, dtype=object)
+        # the rest of the features that are not encoded
+        self.rest_ft_ = pd.Index([ft for ft in df.columns if ft not in self.feat_set_])
+        # order of the columns the model was trained with
+        self.fitted_column_order_ = pd.Index(feat_names).append(self.rest_ft_)
+        # every feature the transform needs, encoded or not
+        self.required_ft_ = self.feat_set_.union(self.rest_ft_)
         return self
 
     def transform(self, df):
-        if set(self.one_hot_enc_ft).issubset(df.columns):
-            # function to one hot encode the features in one_hot_enc_ft
-            def one_hot_enc(df, one_hot_enc_ft):
-                one_hot_enc = OneHotEncoder()
-                one_hot_enc.fit(df[one_hot_enc_ft])
-                # get the result of the one hot encoding columns names
-                feat_names_one_hot_enc = one_hot_enc.get_feature_names_out(
-                    one_hot_enc_ft
-                )
-                # change the array of the one hot encoding to a dataframe with the column names
-                df = pd.DataFrame(
-                    one_hot_enc.transform(df[self.one_hot_enc_ft]).toarray(),
-                    columns=feat_names_one_hot_enc,
-                    index=df.index,
-                )
-                return df
-
-            # function to concatenat the one hot encoded features with the rest of features that were not encoded
-
-            def concat_with_rest(df, one_hot_enc_df, one_hot_enc_ft):
-                # get the rest of the features
-                rest_of_features = [ft for ft in df.columns if ft not in one_hot_enc_ft]
-                # concatenate the rest of the features with the one hot encoded features
-                df_concat = pd.concat([one_hot_enc_df, df[rest_of_features]], axis=1)
-                return df_concat
-
-            # one hot encoded dataframe
-            one_hot_enc_df = one_hot_enc(df, self.one_hot_enc_ft)
-            # returns the concatenated dataframe
-            full_df_one_hot_enc = concat_with_rest(
-                df, one_hot_enc_df, self.one_hot_enc_ft
+        if self.required_ft_.issubset(df.columns):
+            one_hot = np.zeros((len(df), len(self.feat_names_)), dtype=np.uint8)
+            for ft in self.one_hot_enc_ft:
+                # code of each category, unknown categories are -1 and left all zeros
+                idx = pd.Categorical(df[ft], categories=self.categories_[ft]).codes.astype(np.intp)
+                rows = np.flatnonzero(idx >= 0)
+                one_hot[rows, self.col_offsets_[ft] + idx[rows]] = 1
+            # the rest of the features in the fitted order
+            rest = df[self.rest_ft_].to_numpy(dtype=np.float32)
+            # concatenate the one hot encoded features with the rest into a single float32 block
+            full_df_one_hot_enc = pd.DataFrame(
+                np.concatenate([one_hot.astype(np.float32), rest], axis=1),
+                columns=self.fitted_column_order_,
+                index=df.index,
             )
             return full_df_one_hot_enc
         else:
@@ -294,20 +375,25 @@ class SkewnessHandler(BaseEstimator, TransformerMixin):
     ):
         self.col_with_skewness = col_with_skewness
 
-    def fit(self, df):
+    def fit(self, df, y=None):
+        self.feat_set_ = frozenset(self.col_with_skewness)
         return self
 
     def transform(self, df):
-        if set(self.col_with_skewness).issubset(df.columns):
-            # Handle skewness with cubic root transformation
-            df[self.col_with_skewness] = np.cbrt(df[self.col_with_skewness])
+        if self.feat_set_.issubset(df.columns):
+            # Handle skewness with cubic root transformation, in place on a float32 copy of the block
+            block = df[self.col_with_skewness].to_numpy(dtype=np.float32, copy=True)
+            np.cbrt(block, out=block)
+            df[self.col_with_skewness] = block
             return df
         else:
             print("One or more skewed columns are not found")
             return df
 
 
-def full_pipeline(df):
+@cache_resource
+def build_and_fit_pipeline(_train_df):
+    # fitted once per server process, the leading underscore stops streamlit from hashing the training data
     pipeline = Pipeline(
         [
             ("drop features", DropFeatures()),
@@ -320,8 +406,21 @@ def full_pipeline(df):
             ("one hot encoder", OneHotWithFeatNames()),
         ]
     )
-    df_pipe_prep = pipeline.fit_transform(df)
-    return df_pipe_prep
+    pipeline.fit(_train_df.copy())
+    # the fitted steps a new profile goes through, the training-only filters are left out
+    fitted_steps = [
+        (name, step)
+        for name, step in pipeline.steps
+        if not getattr(step, "training_only", False)
+    ]
+    return fitted_steps
+
+
+def transform_one(fitted_steps, row_df):
+    # call the fitted steps directly on the new profile, without the Pipeline machinery
+    for _, step in fitted_steps:
+        row_df = step.transform(row_df)
+    return row_df
 
 
 st.write("""
@@ -437,17 +536,15 @@ profile_to_predict = [
     0,  # loan amount sanctioned
 ]
 
-# Convert to dataframe with column names
+# Convert to a single row dataframe with column names, only this row goes through the fitted pipeline
 profile_to_predict_df = pd.DataFrame([profile_to_predict], columns=train_copy.columns)
 
-# add the profile to predict as a last row in the train data
-train_copy_with_profile_to_pred = pd.concat([train_copy, profile_to_predict_df], ignore_index=True)
+# pipeline steps fitted on the train data
+fitted_steps = build_and_fit_pipeline(train_copy)
 
-# whole dataset prepared
-profile_to_pred_prep = (
-    full_pipeline(train_copy_with_profile_to_pred)
-    .tail(1)
-    .drop(columns=["Loan Sanction Amount (USD)"])
+# profile to predict prepared, the one hot encoder already returns the float32 features the forest compares
+profile_to_pred_prep = transform_one(fitted_steps, profile_to_predict_df).drop(
+    columns=["Loan Sanction Amount (USD)"]
 )
 
 # Animation function
@@ -462,10 +559,50 @@ lottie_loading_an = load_lottieurl(
     "https://assets3.lottiefiles.com/packages/lf20_szlepvdh.json"
 )
 
+model_path = "saved_final_models/Random Forest Regression/trained_Random Forest Regression"
+
+
+class OnnxForest:
+    # the random forest compiled to onnx, behind the same predict method as the sklearn model
+    def __init__(self, onnx_path):
+        self.session = onnxruntime.InferenceSession(
+            onnx_path, providers=["CPUExecutionProvider"]
+        )
+        self.input_name = self.session.get_inputs()[0].name
+        self.n_features_in_ = self.session.get_inputs()[0].shape[1]
+
+    def predict(self, X):
+        X = np.asarray(X, dtype=np.float32)
+        return self.session.run(None, {self.input_name: X})[0].ravel()
+
+
+# the model is deserialized once per server process and shared across reruns
+@cache_resource
+def get_model():
+    onnx_path = model_path + ".onnx"
+    use_onnx = onnxruntime is not None and os.path.exists(onnx_path)
+    # an onnx export older than the trained model is stale, it was made before the last retrain
+    if use_onnx and os.path.getmtime(onnx_path) < os.path.getmtime(model_path):
+        print("The onnx model is older than the trained model, run convert_model.py again")
+        use_onnx = False
+    # prefer the onnx forest, its tree nodes are packed contiguously for faster traversal
+    if use_onnx:
+        model = OnnxForest(onnx_path)
+    else:
+        model = joblib.load(model_path)
+    # one predict on an empty profile at load time, so the one-off costs of the first call
+    # (lazy imports in sklearn, buffer allocation in onnx runtime) are not paid on the first click,
+    # n_jobs is left at its default since joblib starts a new thread pool on every parallel predict
+    warmup_profile = pd.DataFrame(
+        np.zeros((1, model.n_features_in_), dtype=np.float32),
+        columns=getattr(model, "feature_names_in_", None),
+    )
+    model.predict(warmup_profile)
+    return model
+
+
 def make_prediction():
-    with open("saved_final_models/Random Forest Regression/trained_Random Forest Regression", "rb") as fp:
-        model = joblib.load(fp)
-    return model.predict(profile_to_pred_prep)
+    return get_model().predict(profile_to_pred_prep)
 
 if predict_bt:
     with st_lottie_spinner(lottie_loading_an, quality="high", height="200px", width="200px"):
@@ -0,0 +1,81 @@
+# Shrink and convert the saved random forest, so app.py can serve it faster.
+# Needs skl2onnx (pip install skl2onnx onnxruntime), run it once after training the model:
+#   python convert_model.py
+#       converts the saved model to the onnx file app.py serves
+#   python convert_model.py --prune 50 --validation val_prep.csv
+#       keeps the 50 trees with the lowest error on a part of the validation rows, in a separate ".pruned" file,
+#       and reports the rmse of the full and pruned forests on the other part (--select-frac sets the split),
+#       the csv is a prepared validation split with its target, carved out of the train data and kept apart
+#       from the test split, which stays untouched for the final score
+#   python convert_model.py --model "<model path>.pruned"
+#       converts the pruned model instead, once its rmse on the scoring rows is good enough
+# min_samples_leaf=1 when training keeps one value per leaf, the fast path of the forest predict.
+import argparse
+import joblib
+import numpy as np
+import pandas as pd
+
+model_path = "saved_final_models/Random Forest Regression/trained_Random Forest Regression"
+target = "Loan Sanction Amount (USD)"
+
+
+def rmse(y_true, y_pred):
+    return np.sqrt(np.mean((y_true - y_pred) ** 2))
+
+
+def prune_forest(model, X_select, y_select, n_trees):
+    if not 1 <= n_trees <= model.n_estimators:
+        raise ValueError(
+            "n_trees must be between 1 and {0}, got {1}".format(model.n_estimators, n_trees)
+        )
+    # the trees were fitted without feature names, they take a plain float32 matrix
+    X_select = np.asarray(X_select, dtype=np.float32)
+    y_select = np.asarray(y_select)
+    # error of each tree on its own on the selection rows
+    tree_rmse = np.array([rmse(y_select, tree.predict(X_select)) for tree in model.estimators_])
+    # keep the most accurate trees, in their original order
+    keep_idx = np.sort(np.argsort(tree_rmse)[:n_trees])
+    model.estimators_ = [model.estimators_[i] for i in keep_idx]
+    model.n_estimators = len(keep_idx)
+    return model
+
+
+def convert_to_onnx(model_path, onnx_path):
+    # skl2onnx is only needed for the conversion, pruning runs without it
+    from skl2onnx import convert_sklearn
+    from skl2onnx.common.data_types import FloatTensorType
+
+    model = joblib.load(model_path)
+    # the forest takes a float32 matrix with one column per prepared feature
+    initial_types = [("input", FloatTensorType([None, model.n_features_in_]))]
+    onnx_model = convert_sklearn(model, initial_types=initial_types)
+    with open(onnx_path, "wb") as fp:
+        fp.write(onnx_model.SerializeToString())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--prune", type=int, help="number of trees to keep, saved next to the model as .pruned")
+    parser.add_argument("--validation", help="csv of the prepared validation rows with the target, needed by --prune")
+    parser.add_argument("--select-frac", type=float, default=0.5, help="share of the validation rows used to pick the trees")
+    parser.add_argument("--model", default=model_path, help="model to convert to the onnx file served by app.py")
+    args = parser.parse_args()
+    if args.prune is not None:
+        if args.validation is None:
+            parser.error("--prune needs --validation")
+        if not 0 < args.select_frac < 1:
+            parser.error("--select-frac must be between 0 and 1")
+        validation = pd.read_csv(args.validation)
+        # the trees are picked on one part of the rows and scored on the other, so the score is not biased
+        shuffled = validation.sample(frac=1, random_state=42)
+        n_select = int(len(shuffled) * args.select_frac)
+        select, score = shuffled.iloc[:n_select], shuffled.iloc[n_select:]
+        X_score, y_score = score.drop(columns=[target]), score[target]
+        model = joblib.load(model_path)
+        print("Scoring rmse of all {0} trees: {1:.2f}".format(model.n_estimators, rmse(y_score, model.predict(X_score))))
+        pruned = prune_forest(model, select.drop(columns=[target]), select[target], args.prune)
+        print("Scoring rmse of the {0} kept trees: {1:.2f}".format(pruned.n_estimators, rmse(y_score, pruned.predict(X_score))))
+        # the trained model is left untouched, convert the pruned one with --model if it is good enough
+        joblib.dump(pruned, model_path + ".pruned")
+    else:
+        convert_to_onnx(args.model, model_path + ".onnx")